@@ -6,6 +6,7 @@ It requires a bearer token in environment variable : BB_TOKEN.
 """
 
 import argparse
+import concurrent.futures
 import logging
 import os
 import shutil
@@ -18,10 +19,15 @@ import urllib.parse
 from pathlib import Path
 from subprocess import DEVNULL
 
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
 LOG_LEVEL = logging.INFO
 DEFAULT_NUM_THREADS = 4
+DEFAULT_CHECK_WORKERS = 32  # concurrent Bitbucket REST calls during change detection
 LOGGING_DIR = '.clone-project'
 PROCESS_TIMEOUT = 300  # default process timeout
+REQUEST_TIMEOUT = 30  # Bitbucket REST API request timeout
 
 concurrency_sem = threading.Semaphore(DEFAULT_NUM_THREADS)
 
@@ -40,6 +46,17 @@ def main():
         'file shall be one repo clone url per line',
     )
     parser.add_argument('--cloned-repos-path', type=Path, required=True, help='Destination directory to clone repos')
+    parser.add_argument(
+        '--force-update',
+        action='store_true',
+        help='Run `git remote update` on every existing clone, even if its upstream branches have not changed',
+    )
+    parser.add_argument(
+        '--check-workers',
+        type=positive_int,
+        default=DEFAULT_CHECK_WORKERS,
+        help=f'Number of concurrent Bitbucket API calls used to detect changed repos (default {DEFAULT_CHECK_WORKERS})',
+    )
 
     args = parser.parse_args()
     working_dir = os.path.abspath(os.path.expanduser(args.cloned_repos_path))
@@ -68,17 +85,23 @@ def main():
 
     repo_list_file_path = os.path.abspath(os.path.expanduser(args.repo_list))
 
+    with open(repo_list_file_path, encoding="UTF-8") as repo_list_file_handle:
+        clone_urls = [clone_url.strip() for clone_url in repo_list_file_handle if clone_url.strip()]
+
+    # only fetch the existing clones whose upstream branches moved
+    if not args.force_update:
+        clone_urls = find_changed_repos(clone_urls, working_dir, bb_token, args.check_workers)
+
     # start a thread per repo
     threads = []
-    with open(repo_list_file_path, encoding="UTF-8") as repo_list_file_handle:
-        for clone_url in repo_list_file_handle:
-            worker = threading.Thread(target=process_repo, args=(clone_url.strip(), working_dir))
-            threads.append(worker)
-        for worker in threads:
-            worker.daemon = True  # helps to cancel cleanly
-            worker.start()
-        for worker in threads:
-            worker.join(timeout=PROCESS_TIMEOUT)
+    for clone_url in clone_urls:
+        worker = threading.Thread(target=process_repo, args=(clone_url, working_dir))
+        threads.append(worker)
+    for worker in threads:
+        worker.daemon = True  # helps to cancel cleanly
+        worker.start()
+    for worker in threads:
+        worker.join(timeout=PROCESS_TIMEOUT)
 
 
 def process_repo(ssh_clone_url, working_dir):
@@ -132,6 +155,119 @@ def update_repo(repo_name, repo_dir, working_dir):
     return True
 
 
+def find_changed_repos(clone_urls, working_dir, bb_token, check_workers):
+    """
+    Return the clone urls that need a clone or an update, i.e. repos not yet
+    cloned plus existing clones whose upstream refs differ from the local
+    copy.  The checks only use the Bitbucket REST API and local refs, so they
+    run in their own, wider, thread pool without any SSH negotiation.  A repo
+    whose check fails for any reason is updated.
+    """
+    # one session shared by the workers so connections are reused across repos
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json", "Authorization": f"Bearer {bb_token}"})
+    retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=check_workers))
+
+    changed = []
+    checks = {}
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=check_workers) as executor:
+        for clone_url in clone_urls:
+            repo_dir = os.path.join(working_dir, convert_ssh_path_to_repo_name(clone_url))
+            if os.path.isdir(repo_dir):
+                checks[executor.submit(repo_is_current, clone_url, repo_dir, session)] = clone_url
+            else:
+                changed.append(clone_url)
+        for future in concurrent.futures.as_completed(checks):
+            clone_url = checks[future]
+            try:
+                if not future.result():
+                    changed.append(clone_url)
+            except Exception as err:  # any failure falls back to an update, never stops the run
+                logging.warning('Unable to compare refs for %s, updating it: %r', clone_url, err)
+                failed += 1
+                changed.append(clone_url)
+
+    if failed:
+        logging.warning('Change detection failed for %d of %d existing clones, those are all updated',
+                        failed, len(checks))
+    logging.info('%d of %d repos need a clone or update', len(changed), len(clone_urls))
+    return changed
+
+
+def repo_is_current(ssh_clone_url, repo_dir, session):
+    """
+    Compare the upstream refs, fetched from the Bitbucket REST API, with the
+    local ones.  Branches must match refs/remotes/origin/* exactly.  Tags only
+    need to exist in refs/tags/*: `git remote update` does not replace a local
+    tag that was force-moved upstream, so comparing tag commits would flag
+    those repos on every run.  A tag on a commit the fetch never brings down
+    still flags its repo on every run.
+    """
+    repo_name = convert_ssh_path_to_repo_name(ssh_clone_url)
+    rest_url, project_key, repo_slug = parse_bitbucket_clone_url(ssh_clone_url)
+    repo_url = f'{rest_url}/rest/api/1.0/projects/{project_key}/repos/{repo_slug}'
+    branches = get_bitbucket_refs(session, f'{repo_url}/branches')
+    tags = get_bitbucket_refs(session, f'{repo_url}/tags')
+    local_refs = subprocess.run(['git', 'for-each-ref', '--format=%(objectname) %(refname)',
+                                 'refs/remotes/origin', 'refs/tags'],
+                                cwd=repo_dir,
+                                stdin=DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=DEVNULL,
+                                check=True,
+                                text=True,
+                                timeout=PROCESS_TIMEOUT)
+
+    local = dict(reversed(line.split(' ', 1)) for line in local_refs.stdout.splitlines())
+    for ref, sha in branches.items():
+        # `git remote update` maps upstream branches onto refs/remotes/origin/*
+        local_ref = ref.replace('refs/heads/', 'refs/remotes/origin/', 1)
+        if local.get(local_ref) != sha:
+            logging.info('%s changed: %s is %s upstream, %s locally', repo_name, ref, sha, local.get(local_ref))
+            return False
+    for ref in tags:
+        if ref not in local:
+            logging.info('%s changed: %s is missing locally', repo_name, ref)
+            return False
+    return True
+
+
+def get_bitbucket_refs(session, url):
+    """ Return {ref: commit} for a paged Bitbucket branches or tags REST endpoint """
+    refs = {}
+    start = 0
+    while True:
+        response = session.get(url, params={'limit': 1000, 'start': start}, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        response_data = response.json()
+        for ref in response_data.get('values', []):
+            refs[ref['id']] = ref['latestCommit']
+        if response_data.get('isLastPage', True):
+            return refs
+        start = response_data['nextPageStart']
+
+
+def parse_bitbucket_clone_url(ssh_clone_url):
+    """
+    Split a Bitbucket ssh clone url, `ssh://git@host:7999/<project>/<repo>.git`
+    or `git@host:<project>/<repo>.git`, into the REST base url of the same
+    host, the project key and the repo slug
+    """
+    if '://' in ssh_clone_url:
+        parts = urllib.parse.urlparse(ssh_clone_url)
+        host, path = parts.hostname, parts.path
+    else:  # scp-style
+        user_host, path = ssh_clone_url.split(':', 1)
+        host = user_host.rsplit('@', 1)[-1]
+    segments = path.strip('/').split('/')
+    if not host or len(segments) < 2:
+        raise ValueError(f'not a Bitbucket clone url: {ssh_clone_url}')
+    repo_slug, _ = os.path.splitext(segments[-1])
+    return f'https://{host}', segments[-2], repo_slug
+
+
 def clone_repo(ssh_clone_url, repo_name, working_dir):
     """ Using git from the CLI clone  """
     logfile = os.path.join(working_dir, LOGGING_DIR, repo_name)
@@ -155,6 +291,14 @@ def clone_repo(ssh_clone_url, repo_name, working_dir):
     return True
 
 
+def positive_int(value):
+    """ argparse type for options that must be at least 1 """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 def convert_ssh_path_to_repo_name(ssh_path):
     """ strip off the tail `.git` and return the repository base name """
     parts = urllib.parse.urlparse(ssh_path)